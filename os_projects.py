@@ -30,7 +30,6 @@ description:
 requirements:
     - keystoneauth1
     - keystoneclient
-    - inspect
     - logging
     - ansible 2.x
 Tested on:
@@ -79,6 +78,12 @@ options:
         description:
             - description for the project
         required: False
+    token_cache:
+        description:
+            - Path to a file caching the keystone auth state between runs, the
+              token is reused without authenticating until it expires
+        required: False
+        type: path
     state:
         description:
             - If should be present or absent
@@ -108,13 +113,35 @@ sample: uuid
 '''
 
 try:
+    import os
+    import json
+    import tempfile
+    import atexit
+    import logging
+    from logging.handlers import MemoryHandler
+    import requests
+    from requests.adapters import HTTPAdapter
     from keystoneauth1.identity import v3
     from keystoneauth1 import session
+    from keystoneauth1 import exceptions as key_auth1_exceptions
     from keystoneclient.v3 import client
     HAS_CLIENTS = True
 except ImportError:
     HAS_CLIENTS = False
 
+LOG = logging.getLogger(__name__)
+_log_dir = '/var/log/chaperone'
+if os.access(_log_dir, os.W_OK):
+    target = logging.FileHandler(os.path.join(_log_dir, 'os_projects.log'))
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s:%(lineno)d %(message)s')
+    target.setFormatter(formatter)
+    handler = MemoryHandler(256, flushLevel=logging.ERROR, target=target)
+    atexit.register(handler.flush)
+else:
+    handler = logging.NullHandler()
+LOG.addHandler(handler)
+LOG.setLevel(logging.DEBUG)
+
 
 class OpenstackProject(object):
 
@@ -134,23 +161,83 @@ class OpenstackProject(object):
             module.params['project_domain_id'] if module.params['project_domain_id'] else 'default'
         self.project_description = \
             module.params['project_description'] if module.params['project_description'] else 'New Project: %s' % self.project_name
+        self.token_cache = module.params['token_cache']
         self.ks = self.keystone_auth()
         self.project_id = None
-        self.project = None
+        self._existing_project = None
+
+    def _token_cache_key(self):
+        return '%s|%s|%s|%s|%s' % (self.auth_url, self.auth_user_domain, self.auth_user,
+                                   self.auth_project_domain, self.auth_project)
+
+    def _read_token_cache(self):
+        """Returns dict of cached auth states, empty if missing or unreadable"""
+        try:
+            with open(self.token_cache) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def _write_token_cache(self, cache):
+        """Atomically replaces token_cache with cache using mode 0600"""
+        cache_dir = os.path.dirname(os.path.abspath(self.token_cache))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.chmod(tmp_path, 0o600)
+            os.rename(tmp_path, self.token_cache)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            LOG.debug("Failed to write token cache: %s", e)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _restore_auth_state(self, auth):
+        """Returns bool, cached auth state loaded into auth without a keystone call"""
+        if not self.token_cache:
+            return False
+        state = self._read_token_cache().get(self._token_cache_key())
+        if not state:
+            return False
+        try:
+            auth.set_auth_state(state)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            LOG.debug("Ignoring malformed token cache entry: %s", e)
+            return False
+        self._cached_state = state
+        return True
+
+    def _save_auth_state(self):
+        """Stores the current auth state when it differs from the cached one"""
+        if not self.token_cache:
+            return
+        state = self._auth.get_auth_state()
+        if not state or state == self._cached_state:
+            return
+        cache = self._read_token_cache()
+        cache[self._token_cache_key()] = state
+        self._write_token_cache(cache)
 
     def keystone_auth(self):
         ks = None
         try:
-            auth = v3.Password(auth_url=self.auth_url,
-                               username=self.auth_user,
-                               password=self.auth_pass,
-                               project_name=self.auth_project,
-                               project_domain_id=self.auth_project_domain,
-                               user_domain_id=self.auth_user_domain)
-            sess = session.Session(auth=auth, verify=False)
+            self._auth = v3.Password(auth_url=self.auth_url,
+                                     username=self.auth_user,
+                                     password=self.auth_pass,
+                                     project_name=self.auth_project,
+                                     project_domain_id=self.auth_project_domain,
+                                     user_domain_id=self.auth_user_domain)
+            self._cached_state = None
+            self._auth_restored = self._restore_auth_state(self._auth)
+            raw = requests.Session()
+            raw.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+            sess = session.Session(session=raw, auth=self._auth, verify=False)
             ks = client.Client(session=sess)
         except Exception as e:
             msg = "Failed to get client: %s " % str(e)
+            LOG.debug(msg)
             self.module.fail_json(msg=msg)
         return ks
 
@@ -166,15 +253,15 @@ class OpenstackProject(object):
         if module_state:
             changed, result = self.state_exit_unchanged()
 
-        if current_state == 'absent' and desired_state == 'present':
+        elif current_state == 'absent' and desired_state == 'present':
             changed, project = self.state_create_project(self.project_name,
                                                          self.project_domain_id,
                                                          self.project_description)
             self.project_id = project.id
             result = self.project_id
 
-        if current_state == 'present' and desired_state == 'absent':
-            changed, delete_result = self.state_delete_project(self.project)
+        elif current_state == 'present' and desired_state == 'absent':
+            changed, delete_result = self.state_delete_project(self._existing_project)
             result = str(delete_result[0])
 
         self.module.exit_json(changed=changed, result=result, project_id=self.project_id)
@@ -191,6 +278,7 @@ class OpenstackProject(object):
             changed = True
         except Exception as e:
             msg = "Failed to delete Project: %s " % str(e)
+            LOG.debug(msg)
             self.module.fail_json(msg=msg)
         return changed, delete_status
 
@@ -203,39 +291,54 @@ class OpenstackProject(object):
             changed = True
         except Exception as e:
             msg = "Failed to create project: %s " % str(e)
+            LOG.debug(msg)
             self.module.fail_json(msg=msg)
 
         return changed, project
 
+    def _list_projects(self):
+        return self.ks.projects.list(name=self.project_name,
+                                     domain=self.project_domain_id)
+
     def check_project_state(self):
-        project = None
         try:
-            project = [p for p in self.ks.projects.list() if p.name == self.project_name][0]
-        except IndexError:
+            matches = self._list_projects()
+        except key_auth1_exceptions.Unauthorized:
+            if not self._auth_restored:
+                raise
+            LOG.debug("Cached token rejected, authenticating with password")
+            self._auth_restored = False
+            self._auth.invalidate()
+            matches = self._list_projects()
+        self._save_auth_state()
+        LOG.debug("Project: %s matches: %s", self.project_name, len(matches))
+        self._existing_project = matches[0] if matches else None
+        if not self._existing_project:
             return 'absent'
-        self.project_id = project.id
-        self.project = project
+        self.project_id = self._existing_project.id
 
         return 'present'
 
 
 
+_ARG_SPEC = dict(
+    auth_url=dict(required=True, type='str'),
+    auth_user=dict(required=True, type='str'),
+    auth_password=dict(required=True, type='str', no_log=True),
+    auth_project=dict(required=True, type='str'),
+    auth_project_domain=dict(required=True, type='str'),
+    auth_user_domain=dict(required=True, type='str'),
+    project_name=dict(required=True, type='str'),
+    enabled=dict(required=True, type='bool'),
+    project_domain_id=dict(required=False, type='str'),
+    project_description=dict(required=False, type='str'),
+    token_cache=dict(required=False, type='path'),
+    state=dict(default='present', choices=['present', 'absent'], type='str'),
+)
+
+
 def main():
-    argument_spec = dict(
-        auth_url=dict(required=True, type='str'),
-        auth_user=dict(required=True, type='str'),
-        auth_password=dict(required=True, type='str', no_log=True),
-        auth_project=dict(required=True, type='str'),
-        auth_project_domain=dict(required=True, type='str'),
-        auth_user_domain=dict(required=True, type='str'),
-        project_name=dict(required=True, type='str'),
-        enabled=dict(required=True, type='bool'),
-        project_domain_id=dict(required=False, type='str'),
-        project_description=dict(required=False, type='str'),
-        state=dict(default='present', choices=['present', 'absent'], type='str'),
-    )
-
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=False)
+    module = AnsibleModule(argument_spec=_ARG_SPEC, supports_check_mode=False)
 
     if not HAS_CLIENTS:
         module.fail_json(msg='python-keystone is required for this module')
@@ -78,12 +78,33 @@ sample:
 '''
 
 try:
+    import os
     import time
+    import json
+    import atexit
+    import logging
+    from logging.handlers import MemoryHandler
     import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+    from multiprocessing.pool import ThreadPool
     IMPORTS = True
 except ImportError:
     IMPORTS = False
 
+LOG = logging.getLogger(__name__)
+_log_dir = '/var/log/chaperone'
+if os.access(_log_dir, os.W_OK):
+    target = logging.FileHandler(os.path.join(_log_dir, 'vcenter_vrops_config.log'))
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s:%(lineno)d %(message)s')
+    target.setFormatter(formatter)
+    handler = MemoryHandler(256, flushLevel=logging.ERROR, target=target)
+    atexit.register(handler.flush)
+else:
+    handler = logging.NullHandler()
+LOG.addHandler(handler)
+LOG.setLevel(logging.DEBUG)
+
 
 ## vrops api paths this needs fixings
 _security         = 'security/%s'
@@ -108,20 +129,26 @@ adminpassword     = 'adminpassword'
 admin_pass_init   = 'initial'
 admin_pass        = '%s/%s'
 
+NTP_PATH                = _sysadmin % (_cluster % ntp)
+ADMIN_ROLE_STATUS_PATH  = _deployment % (_slice % (_role % _status))
+ADMIN_ROLE_PATH         = _deployment % (_slice % role)
+ADMIN_PASS_INIT_PATH    = _security % (admin_pass % (adminpassword, admin_pass_init))
+CLUSTER_INFO_PATH       = _deployment % (_cluster % _info)
+SLICE_PATH              = _deployment % slice_
+
 _headers          = { 'Content-Type': 'application/json', 'Accept': 'application/json' }
 
-# need a better way to read in body for different calls this is static
-_set_admin_role_body = [{ "slice_address": "", "admin_slice": "",
-                          "is_ha_enabled": True, "user_id": "", "password": "",
-                          "slice_roles": ["ADMIN","DATA","UI"] }]
+# 500 is left out since the casa api answers 500 when the initial password is already set
+_retry_methods    = frozenset(['GET', 'PUT', 'POST', 'DELETE'])
+_retry_statuses   = (502, 503, 504)
+# connect, read seconds so a stalled appliance hits the retry path
+_timeout          = (10, 60)
 
-class VropsRestClientExceptions(Exception):
-    def __init__(self, msg):
-        self.msg = msg
-    def __str__(self):
-        log(self.msg)
-        return self.msg
+_ENCODE           = json.JSONEncoder(separators=(',', ':')).encode
 
+# values are substituted json encoded so quotes in passwords stay valid
+_ADMIN_ROLE_TEMPLATE = ('[{"slice_address":%s,"admin_slice":%s,"is_ha_enabled":true,'
+                        '"user_id":%s,"password":%s,"slice_roles":["ADMIN","DATA","UI"]}]')
 
 class VropsRestClient(object):
     """ A basic vROPs rest client to configure the appliance
@@ -135,49 +162,96 @@ class VropsRestClient(object):
         self._base_user_url  = 'https://%s/suite-api/api/%s'
         self._base_admin_url = 'https://%s/casa/%s'
         self.auth            = (self._username, self._password)
+        self._ntp_url               = self._base_admin_url % (self._server, NTP_PATH)
+        self._admin_role_status_url = self._base_admin_url % (self._server, ADMIN_ROLE_STATUS_PATH)
+        self._admin_role_url        = self._base_admin_url % (self._server, ADMIN_ROLE_PATH)
+        self._admin_pass_init_url   = self._base_admin_url % (self._server, ADMIN_PASS_INIT_PATH)
+        self._cluster_info_url      = self._base_admin_url % (self._server, CLUSTER_INFO_PATH)
+        self._slice_url             = self._base_admin_url % (self._server, SLICE_PATH)
+        self._server_slice_url      = self._base_admin_url % (self._server, _deployment % (_slice % self._server))
+        self._session        = requests.Session()
+        self._session.auth   = self.auth
+        self._session.verify = False
+        self._session.headers.update(_headers)
+        self._session.mount('https://', HTTPAdapter(max_retries=self._retry(),
+                                                    pool_connections=4, pool_maxsize=8))
+
+    @staticmethod
+    def _retry():
+        """Returns urllib3 Retry for transient connection errors and 5xx
+        while the appliance is still booting
+        """
+        retry_args = {'total': 5, 'backoff_factor': 0.5,
+                      'status_forcelist': _retry_statuses, 'raise_on_status': False}
+        try:
+            return Retry(allowed_methods=_retry_methods, **retry_args)
+        except TypeError:
+            # urllib3 < 1.26
+            return Retry(method_whitelist=_retry_methods, **retry_args)
+
+    def __del__(self):
+        session = getattr(self, '_session', None)
+        if session:
+            session.close()
 
     def do_request(self, request_type, status_codes, params):
         """Returns status code of rest call and json content
-        returns None, None on failure
+        returns None, None on request failure, status code, None
+        if the status code is not in status_codes
         :param request_type: get, put, post, delete
         :param status_codes: list of accepted status codes
-        :param params: dict of requests.<request_type> accepted parameters
+        :param params: dict of requests.Session.request accepted parameters,
+            auth headers and verify are carried by the session,
+            timeout defaults to _timeout
         """
         resp  = None
         content = None
         status_code = None
 
+        LOG.debug("REQ %s URL %s", request_type, params['url'])
+        params.setdefault('timeout', _timeout)
+
         try:
-            if request_type == 'get':
-                resp = requests.get(**params)
-            if request_type == 'put':
-                resp = requests.put(**params)
-            if request_type == 'post':
-                resp = requests.post(**params)
-            if request_type == 'delete':
-                resp = requests.delete(**params)
-            status_code = resp.status_code
-        except (requests.exceptions.ConnectionError, requests.RequestException) as conn_error:
-            msg = "Failed Request GET Error: %s " % str(conn_error)
-            raise VropsRestClientExceptions(msg=msg)
-        except Exception as e:
-            msg = "General Failure: %s " % str(e)
-            raise VropsRestClientExceptions(msg=msg)
+            resp = self._session.request(request_type, **params)
+        except requests.RequestException as e:
+            LOG.debug("Failed Request %s Error: %s", request_type, e)
+            return None, None
+
+        status_code = resp.status_code
 
-        if status_code not in status_codes:
-            msg = "Status Code: %s not in status codes: %s " % (status_code, status_codes)
-            raise VropsRestClientExceptions(msg=msg)
         if status_code == 401:
-            msg = "Status Code: %s UNAUTHORIZED" % status_code
-            raise VropsRestClientExceptions(msg=msg)
+            LOG.debug("Status Code: %s UNAUTHORIZED", status_code)
+            return status_code, None
+        if status_code not in status_codes:
+            LOG.debug("Status Code: %s not in status codes: %s", status_code, status_codes)
+            return status_code, None
 
         try:
-            content = resp.json()
-        except Exception as e:
+            content = resp.json() if resp.content else None
+        except ValueError:
             pass
 
         return status_code, content
 
+    def _wait_until(self, pred, timeout=300, base=0.5, cap=10):
+        """Returns True once pred() is true, False after timeout seconds
+        polls with exponential backoff capped at cap seconds
+        :param pred: callable returning bool
+        :param timeout: seconds to wait before giving up
+        """
+        deadline = time.time() + timeout
+        attempt  = 0
+
+        while not pred():
+            delay = min(cap, base * 2 ** attempt)
+            if time.time() + delay > deadline:
+                LOG.debug("Timed out after %s seconds", timeout)
+                return False
+            time.sleep(delay)
+            attempt += 1
+
+        return True
+
     def api_url(self, url_tpye=None, path=None):
         url = self._base_url
         if url_tpye == 'admin' and path:
@@ -187,39 +261,24 @@ class VropsRestClient(object):
         return url
 
     def api_state(self):
-        state  = False
         _url   = self.api_url()
-        params = {'url': _url, 'verify': False}
+        params = {'url': _url}
 
-        state, content = self.do_request('get', [200], params)
+        status_code, content = self.do_request('get', [200], params)
 
-        return state
+        return status_code == 200
 
     def body_to_json(self, body):
-        json_body = None
-
-        try:
-            json_body = json.dumps(body)
-        except Exception as e:
-            return json_body
-
-        return json_body
+        return _ENCODE(body)
 
     def _update_ntp_servers(self, ntp_servers, content):
         """Returns list of desired ntp servers to configure
         :param ntp_servers: list of desired ntp servers
         :param content: content from get sysadmin/cluster/ntp
         """
-        update_list         = []
-        current_ntp_servers = [n['address'] for n in content['time_servers']]
-
-        if set(ntp_servers) == set(current_ntp_servers):
-            return update_list
+        current = {n['address'] for n in content['time_servers']}
 
-        common_servers = list(set(ntp_servers) & set(current_ntp_servers))
-        update_list    = [s for s in ntp_servers if s not in common_servers]
-
-        return update_list
+        return [s for s in ntp_servers if s not in current]
 
     def ntp_state(self, ntp_servers):
         """Returns bool, list of ntp servers to update
@@ -227,17 +286,16 @@ class VropsRestClient(object):
         """
         state    = False
         ntp_list = None
-        path     = _sysadmin % _cluster % ntp
-        url      = self.api_url('admin', path)
+        params   = {'url': self._ntp_url}
 
-        params = {'url': url, 'auth': self.auth,
-                  'headers': _headers, 'verify': False}
+        if not ntp_servers:
+            return True, []
 
         status_code, content = self.do_request('get', [200], params)
 
-        if not content['time_servers']:
-            log("Currently no ntp servers set state: %s " % state)
-            log("ntp_servers: %s " % ntp_servers)
+        if not content or not content['time_servers']:
+            LOG.debug("Currently no ntp servers set state: %s", state)
+            LOG.debug("ntp_servers: %s", ntp_servers)
             return False, ntp_servers
 
         ntp_list = self._update_ntp_servers(ntp_servers, content)
@@ -254,129 +312,127 @@ class VropsRestClient(object):
         return body
 
     def set_ntp(self, ntp_servers):
-        state  = False
-        path   = _sysadmin % _cluster % ntp
-        url    = self.api_url('admin', path)
         body   = self.ntp_body(ntp_servers)
         _body  = self.body_to_json(body)
-        params = {'url': url, 'auth': self.auth, 'data': _body,
-                  'headers': _headers, 'verify': False}
+        params = {'url': self._ntp_url, 'data': _body}
 
-        state, content = self.do_request('post', [200], params)
+        status_code, content = self.do_request('post', [200], params)
 
-        return state
+        return status_code == 200
+
+    def configure_ntp(self, ntp_servers, ntp_probe=None):
+        """Returns bool, ntp servers configured
+        :param ntp_servers: list of desired ntp servers
+        :param ntp_probe: result of ntp_state, fetched when not given
+        """
+        if not ntp_servers:
+            return True
 
-    def configure_ntp(self, ntp_servers):
-        ntp_state, ntp_list = self.ntp_state(ntp_servers)
+        ntp_state, _ = ntp_probe if ntp_probe else self.ntp_state(ntp_servers)
 
         if ntp_state:
             return ntp_state
 
-        set_ntp_servers = self.set_ntp(ntp_list)
-        return set_ntp_servers
+        # the casa api replaces time_servers, so post the full desired list
+        if not self.set_ntp(ntp_servers):
+            return False
 
-    def reset_admin_password(self):
-        path   = _security % adminpassword
-        _url   = self.api_url('admin', path)
-        body   = { "old_password": self._password, "password": self._password }
-        _body  = self.body_to_json(body)
-
-        params = {'url': _url, 'verify': False, 'auth': self.auth,
-                  'data': _body, 'headers': _headers}
-
-        status_code, content = self.do_request('put', [200, 500], params)
-
-        if status_code == 500:
-            raise VropsRestClientExceptions(msg="Failed to reset Admin Password")
-
-        return True
+        return self._wait_until(lambda: self.ntp_state(ntp_servers)[0])
 
     def set_admin_init_password(self):
-        state    = False
-        path     = _security % admin_pass % (adminpassword, admin_pass_init)
-        _url     = self.api_url('admin', path)
         body     = { "password": self._password }
         _body    = self.body_to_json(body)
 
-        params   = {'url': _url, 'verify': False,
-                    'data': _body, 'headers': _headers}
+        params   = {'url': self._admin_pass_init_url, 'data': _body}
 
         status_code, content = self.do_request('put', [200, 500], params)
 
-        if status_code == 500:
-            state = self.reset_admin_password()
+        if status_code == 500 and content and \
+                content.get('error_message_key') == 'security.initial_password_already_set':
+            return True
 
-        return state
+        return status_code == 200
 
     def admin_role_state(self):
         state  = False
-        path   = _deployment % _slice % _role % _status
-        _url   = self._base_admin_url % (self._server, path)
-
-        params = {'url': _url, 'auth': self.auth,
-                  'verify': False, 'headers': _headers}
+        params = {'url': self._admin_role_status_url}
 
         status_code, content = self.do_request('get', [200], params)
 
-        if status_code:
+        if content:
             state = content['configurationRunning']
 
         return state
 
-    def admin_role_body(self, _admin_role_body):
-        for body in _admin_role_body:
-            body.update({'slice_address': self._server})
-            body.update({'admin_slice': self._server})
-            body.update({'user_id': self._username})
-            body.update({'password': self._password})
-        return _admin_role_body
-
     def set_admin_role(self):
-        state  = False
-        path   = _deployment % _slice % role
-        _url   = self.api_url('admin', path)
-        body   = self.admin_role_body(_set_admin_role_body)
-        _body  = self.body_to_json(body)
+        _body  = _ADMIN_ROLE_TEMPLATE % (_ENCODE(self._server), _ENCODE(self._server),
+                                         _ENCODE(self._username), _ENCODE(self._password))
 
-        params = {'url': _url, 'verify': False, 'auth': self.auth,
-                  'data': _body, 'headers': _headers}
+        params = {'url': self._admin_role_url, 'data': _body}
 
-        state, content = self.do_request('post', [202], params)
-        return state
+        status_code, content = self.do_request('post', [202], params)
+        return status_code == 202
 
-    def admin_role(self):
+    def admin_role(self, role_running=True):
+        """Returns bool, admin role set
+        :param role_running: result of admin_role_state, polled until
+            no configuration is running when True
+        """
         set_role = False
 
-        if not self.admin_role_state():
+        if not role_running or self._wait_until(lambda: not self.admin_role_state()):
             set_role = self.set_admin_role()
 
         return set_role
 
+    def bootstrap_node(self, set_admin_pass, ntp_servers):
+        """Returns bool, bool for ntp and admin role configuration
+        sets the initial admin password first, then probes ntp and admin
+        role state concurrently over the shared session before the writes
+        :param set_admin_pass: bool, set the initial admin password
+        :param ntp_servers: list of desired ntp servers, may be None
+        """
+        ntp_result = None
+
+        if set_admin_pass and not self.set_admin_init_password():
+            LOG.error("Failed to set initial admin password")
+            return False, False
+
+        pool = ThreadPool(processes=2)
+        try:
+            ntp_probe  = pool.apply_async(self.ntp_state, (ntp_servers,)) if ntp_servers else None
+            role_probe = pool.apply_async(self.admin_role_state)
+            if ntp_probe:
+                ntp_result = ntp_probe.get()
+            role_running = role_probe.get()
+        finally:
+            pool.close()
+            pool.join()
+
+        ntp_ok   = self.configure_ntp(ntp_servers, ntp_result)
+        set_role = self.admin_role(role_running)
+
+        return ntp_ok, set_role
+
     def cluster_state_name(self, cluster_name):
         state    = False
-        path     = _deployment % _cluster % _info
-        _url     = self._base_admin_url % (self._server, path)
-        params   = {'url': _url, 'verify': False, 'auth': self.auth, 'headers': _headers}
+        params   = {'url': self._cluster_info_url}
 
         status_code, content = self.do_request('get', [200], params)
 
-        if status_code == 200:
+        if content:
             state = (content['cluster_name'] == cluster_name)
 
         return state
 
     def configure_cluster(self, cluster_name):
-        state    = False
-        path     = _deployment % _cluster % _info
-        _url     = self._base_admin_url % (self._server, path)
         body     = { 'cluster_name': cluster_name }
         _body    = self.body_to_json(body)
 
-        params   = {'url': _url, 'verify': False, 'auth': self.auth,
-                    'headers': _headers, 'data': _body}
+        params   = {'url': self._cluster_info_url, 'data': _body}
 
         status_code, content = self.do_request('put', [200], params)
-        return state
+        return status_code == 200
 
     def configure_cluster_name(self, cluster_name):
         state = False
@@ -386,27 +442,21 @@ class VropsRestClient(object):
 
     def slice_state_name(self):
         state  = False
-        path   = _deployment % slice_
-        _url   = self._base_admin_url % (self._server, path)
-        params = {'url': _url, 'verify': False,
-                  'auth': self.auth, 'headers': _headers}
+        params = {'url': self._slice_url}
 
         status_code, content = self.do_request('get', [200], params)
 
-        if content['slice_name'] == self._server:
+        if content and content['slice_name'] == self._server:
             state = True
 
         return state
 
     def configure_slice(self):
         state  = False
-        path   = _deployment % _slice % self._server
-        _url   = self._base_admin_url % (self._server, path)
         body   = {'slice_name': self._server }
         _body  = self.body_to_json(body)
 
-        params = {'url': _url, 'verify': False, 'data': _body,
-                  'auth': self.auth, 'headers': _headers}
+        params = {'url': self._server_slice_url, 'data': _body}
 
         status_code, content = self.do_request('put', [200], params)
 
@@ -468,13 +518,9 @@ class VropsConfig(object):
             msg = "API should be ready but is not"
             self._fail(msg)
 
-        if self.module.params['set_admin_pass']:
-            admin_password_state = self.vrops_client.set_admin_init_password()
+        _ntp_state, admin_role = \
+            self.vrops_client.bootstrap_node(self.module.params['set_admin_pass'], self._ntp_servers)
 
-        if 'ntp_servers' in self.module.params:
-            _ntp_state = self.vrops_client.configure_ntp(self._ntp_servers)
-
-        admin_role    = self.vrops_client.admin_role()
         cluster_name  = self.vrops_client.configure_cluster_name(self.module.params['cluster_name'])
         slice_name    = self.vrops_client.configure_slice_name()
 
@@ -506,16 +552,17 @@ class VropsConfig(object):
         return state
 
 
+_ARG_SPEC = dict(administrator=dict(required=True, type='str'),
+                 password=dict(required=True, type='str', no_log=True),
+                 set_admin_pass=dict(required=False, type='bool'),
+                 vrops_ip_addess=dict(required=True, type='str'),
+                 cluster_name=dict(required=False, type='str'),
+                 ntp_servers=dict(required=False, type='list'),
+                 state=dict(default='present', choices=['present', 'absent']),)
+
+
 def main():
-    argument_spec = dict(administrator=dict(required=True, type='str'),
-                         password=dict(required=True, type='str', no_log=True),
-                         set_admin_pass=dict(required=False, type='bool'),
-                         vrops_ip_addess=dict(required=True, type='str'),
-                         cluster_name=dict(required=False, type='str'),
-                         ntp_servers=dict(required=False, type='list'),
-                         state=dict(default='present', choices=['present', 'absent']),)
-
-    module = AnsibleModule(argument_spec=argument_spec,
+    module = AnsibleModule(argument_spec=_ARG_SPEC,
                            supports_check_mode=False)
 
     if not IMPORTS: